@@ -2,6 +2,12 @@
 # Fully rewritten: safe session_state, form-based input, no experimental_rerun
 
 import os
+import re
+import html
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from google import genai
 import streamlit as st
@@ -11,7 +17,29 @@ from google.genai import types
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
-client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else genai.Client()
+
+@st.cache_resource(show_spinner=False)
+def get_client():
+    # One client (and HTTP connection pool) per process, not per rerun
+    return genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else genai.Client()
+
+@st.cache_resource(show_spinner=False)
+def get_generation_config(max_output_tokens, temperature):
+    # Built once per (max_output_tokens, temperature) pair, e.g. 768/0.7 and 512/0.6
+    return types.GenerateContentConfig(
+        max_output_tokens = max_output_tokens,
+        temperature = temperature
+    )
+
+CONTEXT_TOKEN_BUDGET = 1500
+REPLY_WORKERS = 8
+# gemini-2.5-flash thinks before its first text chunk, which routinely takes more than 5 s,
+# so only a primary that has been silent well past normal thinking time is hedged
+FALLBACK_DELAY = 20
+REPLY_CACHE_TTL = 24 * 60 * 60
+REPLY_CACHE_MAX_ENTRIES = 512
+
+EMPTY_REPLY = "⚠️ I couldn't generate a response. Try simplifying the request."
 
 # ----------------- System prompt -----------------
 SYSTEM_PROMPT = (
@@ -24,30 +52,52 @@ SYSTEM_PROMPT = (
     "Format: bold titles and 1-line explanation under each item."
 )
 
+# Steering prefixes, applied when the request mentions exactly one of these topics
+STEER_RULES = {
+    "service": "Give me creative service ideas only. ",
+    "business": "Give me business ideas only — not personal services. ",
+}
+STEER_RE = re.compile(r"\b(" + "|".join(STEER_RULES) + r")(?:e?s)?\b", re.IGNORECASE)
+# Splits a batched reply at its "[i] IdeaForge:" markers, tolerating markdown such as "**[0] IdeaForge:**"
+# Closing emphasis after the colon is only consumed when whitespace follows, so an
+# answer that opens with "**Title**" keeps its markup
+BATCH_REPLY_RE = re.compile(r"^\W*\[(\d+)\]\W*IdeaForge\W*?:(?:[*_]+(?=\s|$))?", re.MULTILINE)
+# Requests per batch call; at 768 output tokens each this stays well inside the model's output limit
+BATCH_MAX_REQUESTS = 8
+
+CHAT_CSS = """
+<style>
+.chat-row { display:flex; margin-bottom:8px; }
+.user-bubble { background: rgba(59,130,246,0.2); color: #e6f0ff; padding:10px 14px; border-radius:12px; margin-left:auto; max-width:78%; }
+.bot-bubble { background:#1f2937; color: #e6eef8; padding:10px 14px; border-radius:12px; max-width:78%; }
+.meta { color:#94a3b8; font-size:12px; margin-bottom:6px; }
+</style>
+"""
+
 # ----------------- Helpers -----------------
-def extract_text_from_response(resp):
+def extract_text_from_response(resp, strip=True):
+    # Runs once per streamed chunk, so read each part's text attribute only once
     try:
-        if not resp:
-            return None
-        if hasattr(resp, "candidates") and resp.candidates:
-            cand = resp.candidates[0]
-            if hasattr(cand, "content") and cand.content and hasattr(cand.content, "parts"):
-                parts = cand.content.parts
-                texts = [p.text for p in parts if getattr(p, "text", None)]
-                if texts:
-                    return "\n".join(texts).strip()
-        if hasattr(resp, "text") and resp.text:
-            return resp.text.strip()
-    except Exception:
+        candidates = getattr(resp, "candidates", None)
+        parts = getattr(getattr(candidates[0], "content", None), "parts", None) if candidates else None
+        if parts:
+            texts = [t for p in parts if (t := getattr(p, "text", None))]
+            if texts:
+                return "\n".join(texts).strip() if strip else "".join(texts)
+        text = getattr(resp, "text", None)
+        if text:
+            return text.strip() if strip else text
+    except AttributeError:
         return None
     return None
 
-def generate_with_gemini(prompt, max_output_tokens=512, temperature=0.6):
+# The Gemini helpers take the client and config as arguments: they run on pool threads,
+# so both are resolved on the script thread (see gemini_args) before submitting
+def gemini_args(max_output_tokens, temperature):
+    return get_client(), get_generation_config(max_output_tokens, float(temperature))
+
+def generate_with_gemini(prompt, client, config):
     try:
-        config = types.GenerateContentConfig(
-            max_output_tokens = max_output_tokens,
-            temperature = float(temperature)
-        )
         response = client.models.generate_content(
             model = GEMINI_MODEL,
             contents = [SYSTEM_PROMPT, prompt],
@@ -59,20 +109,248 @@ def generate_with_gemini(prompt, max_output_tokens=512, temperature=0.6):
     except Exception as e:
         raise RuntimeError(str(e))
 
+def stream_with_gemini(prompt, client, config):
+    try:
+        stream = client.models.generate_content_stream(
+            model = GEMINI_MODEL,
+            contents = [SYSTEM_PROMPT, prompt],
+            config = config
+        )
+        try:
+            for chunk in stream:
+                # Keep chunk whitespace intact; the joined reply is stripped once at the end
+                text = extract_text_from_response(chunk, strip=False)
+                if text:
+                    yield text
+        finally:
+            # Close the SDK stream (and its HTTP response) when the caller stops early
+            getattr(stream, "close", lambda: None)()
+
+    except Exception as e:
+        raise RuntimeError(str(e))
+
+def run_reply(prompt, progress, client, config):
+    # Runs on a pool thread: no Streamlit calls here, only writes to the shared progress dict
+    progress["started_at"] = time.time()
+    reply = ""
+    stream = stream_with_gemini(prompt, client, config)
+    try:
+        for text in stream:
+            if progress.get("cancelled"):
+                break
+            reply += text
+            progress["text"] = reply
+    finally:
+        stream.close()
+    return reply.strip() or None
+
+def start_fallback(prompt):
+    return get_pool().submit(
+        generate_with_gemini, prompt + "\nPlease try again concisely.", *gemini_args(512, 0.6)
+    )
+
+def poll_reply(inflight):
+    # Returns the finished reply, or None while still waiting. The streamed primary
+    # reply wins; the concise fallback is only started (and used) when the primary
+    # has been running silently for FALLBACK_DELAY seconds or ends empty.
+    primary = inflight["future"]
+    if primary.done():
+        try:
+            reply = primary.result()
+        except RuntimeError as e:
+            return describe_gemini_error(str(e))
+        if reply:
+            cache_reply(inflight["prompt"], reply)
+            return reply
+    else:
+        # The clock starts when a worker picks the primary up, so requests waiting in a
+        # busy pool don't each add a fallback job to it
+        started_at = inflight["progress"]["started_at"]
+        if inflight["progress"]["text"] or not primary.running() or started_at is None:
+            return None
+        if time.time() - started_at < FALLBACK_DELAY:
+            return None
+
+    fallback = inflight["fallback"]
+    if fallback is None:
+        inflight["fallback"] = start_fallback(inflight["prompt"])
+        return None
+    if not fallback.done():
+        return None
+    try:
+        reply = fallback.result()
+    except RuntimeError as e:
+        # A silent primary may still answer; only report the error once it has ended too
+        return describe_gemini_error(str(e)) if primary.done() else None
+    if reply:
+        cache_reply(inflight["prompt"], reply)
+        return reply
+    return EMPTY_REPLY if primary.done() else None
+
+def cancel_inflight(inflight):
+    # Stop the calls behind a request whose result is no longer needed: the flag ends a
+    # streaming primary at its next chunk, and cancel() drops jobs no worker has started
+    inflight["progress"]["cancelled"] = True
+    for key in ("future", "fallback"):
+        if inflight.get(key):
+            inflight[key].cancel()
+
+def poll_batch(inflight):
+    # Returns one reply per queued request, or None while the batch call is still running
+    if not inflight["future"].done():
+        return None
+    count = len(inflight["user_texts"])
+    try:
+        batch_reply = inflight["future"].result()
+    except RuntimeError as e:
+        return [describe_gemini_error(str(e))] * count
+    answers = split_batch_reply(batch_reply, count)
+    # Only cache replies that split cleanly, so a malformed one isn't replayed for a day
+    if all(answers):
+        cache_reply(inflight["prompt"], batch_reply)
+    return [answer or EMPTY_REPLY for answer in answers]
+
+@st.cache_resource
+def get_pool():
+    return ThreadPoolExecutor(max_workers=REPLY_WORKERS)
+
+@st.cache_resource
+def get_reply_cache():
+    # Shared across reruns and sessions: prompt -> (stored_at, reply), oldest first.
+    # Every session's script thread touches it, so all access goes through the lock.
+    return threading.Lock(), OrderedDict()
+
+def get_cached_reply(prompt):
+    lock, cache = get_reply_cache()
+    with lock:
+        entry = cache.get(prompt)
+        if not entry:
+            return None
+        stored_at, reply = entry
+        if time.time() - stored_at > REPLY_CACHE_TTL:
+            del cache[prompt]
+            return None
+        return reply
+
+def cache_reply(prompt, reply):
+    lock, cache = get_reply_cache()
+    with lock:
+        cache[prompt] = (time.time(), reply)
+        cache.move_to_end(prompt)
+        while len(cache) > REPLY_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+def clear_reply_cache():
+    lock, cache = get_reply_cache()
+    with lock:
+        cache.clear()
+
+def steer_request(text):
+    hits = {m.group(1).lower() for m in STEER_RE.finditer(text)}
+    steer = STEER_RULES[hits.pop()] if len(hits) == 1 else ""
+    return f"{steer}{text}"
+
+def build_batch_prompt(convo_text, requests):
+    numbered = "\n".join(f"[{i}] User: {steer_request(q)}" for i, q in enumerate(requests))
+    layout = "\n".join(f"[{i}] IdeaForge: ..." for i in range(len(requests)))
+    return f"{convo_text}\nAnswer each numbered request separately.\n{numbered}\nRespond as:\n{layout}"
+
+def split_batch_reply(text, count):
+    answers = [None] * count
+    matches = list(BATCH_REPLY_RE.finditer(text or ""))
+    for m, nxt in zip(matches, matches[1:] + [None]):
+        i = int(m.group(1))
+        if i < count:
+            answers[i] = text[m.end():nxt.start() if nxt else len(text)].strip() or None
+    if not matches and text and text.strip():
+        # No markers at all: keep the raw reply on the first request rather than dropping it
+        answers[0] = text.strip()
+    return answers
+
+def describe_gemini_error(err):
+    if "429" in err:
+        return "🚦 Gemini quota / rate limit reached. Try again later or use a different key."
+    return f"⚠️ Error calling Gemini: {err}"
+
+def trim_turn(user_text, reply, budget_chars):
+    # Fit one turn into budget_chars by trimming inside the messages at word boundaries:
+    # the head of the request (up to a quarter of the budget) and the tail of the reply
+    user_chars = budget_chars // 4
+    if len(user_text) > user_chars:
+        user_text = user_text[:user_chars].rsplit(None, 1)[0] + " …"
+    reply_chars = max(budget_chars - len(user_text), 0)
+    if len(reply) > reply_chars:
+        words = reply[len(reply) - reply_chars:].split(None, 1)
+        reply = "… " + (words[-1] if words else "")
+    return f"User: {user_text}\nIdeaForge: {reply}"
+
+def build_context(history, token_budget):
+    # Keep the newest turns that fit the budget, estimating ~4 characters per token
+    budget_chars = token_budget * 4
+    kept = []
+    for user_text, reply in reversed(history):
+        turn = f"User: {user_text}\nIdeaForge: {reply}"
+        if len(turn) > budget_chars:
+            if not kept:
+                # An oversized newest turn is trimmed so follow-ups still see the last reply
+                kept.append(trim_turn(user_text, reply, budget_chars))
+            break
+        budget_chars -= len(turn)
+        kept.append(turn)
+    return "\n".join(reversed(kept))
+
+def add_turn(user_text, reply):
+    st.session_state.history.append((user_text, reply))
+    # Render each turn once here so reruns only join the cached HTML
+    st.session_state.rendered.append(bubble_html(user_text, role="user") + bubble_html(reply))
+
+def start_reply(user_text):
+    # Decode on a pool thread so the page stays interactive; polled at the end of the script
+    convo_text = build_context(st.session_state.history, st.session_state.context_budget)
+    prompt = f"{convo_text}\nUser: {steer_request(user_text)}\nIdeaForge:"
+    reply = get_cached_reply(prompt)
+    if reply:
+        add_turn(user_text, reply)
+        return
+    progress = {"text": "", "started_at": None}
+    st.session_state.inflight = {
+        "batch": False,
+        "user_texts": [user_text],
+        "prompt": prompt,
+        "progress": progress,
+        "future": get_pool().submit(run_reply, prompt, progress, *gemini_args(768, 0.7)),
+        "fallback": None,
+    }
+
+def start_batch(requests):
+    # One Gemini call for all queued requests; the shared context is sent once
+    convo_text = build_context(st.session_state.history, st.session_state.context_budget)
+    prompt = build_batch_prompt(convo_text, requests)
+    batch_reply = get_cached_reply(prompt)
+    if batch_reply:
+        for user_text, reply in zip(requests, split_batch_reply(batch_reply, len(requests))):
+            add_turn(user_text, reply)
+        return
+    st.session_state.inflight = {
+        "batch": True,
+        "user_texts": requests,
+        "prompt": prompt,
+        "progress": {"text": ""},
+        "future": get_pool().submit(generate_with_gemini, prompt, *gemini_args(768 * len(requests), 0.7)),
+    }
+
+def bubble_html(text, role="bot"):
+    # Messages are injected with unsafe_allow_html, so escape them first
+    text = html.escape(text).replace("\n", "<br>")
+    if role == "user":
+        return f"<div class='chat-row'><div class='user-bubble'><div class='meta'>You</div>{text}</div></div>"
+    return f"<div class='chat-row'><div class='bot-bubble'><div class='meta'>IdeaForge</div>{text}</div></div>"
+
 # ----------------- Streamlit UI -----------------
 st.set_page_config(page_title="IdeaForge — Chat", page_icon="💡", layout="wide")
 
-st.markdown(
-    """
-    <style>
-    .chat-row { display:flex; margin-bottom:8px; }
-    .user-bubble { background: rgba(59,130,246,0.2); color: #e6f0ff; padding:10px 14px; border-radius:12px; margin-left:auto; max-width:78%; }
-    .bot-bubble { background:#1f2937; color: #e6eef8; padding:10px 14px; border-radius:12px; max-width:78%; }
-    .meta { color:#94a3b8; font-size:12px; margin-bottom:6px; }
-    </style>
-    """,
-    unsafe_allow_html=True
-)
+# Emitted on every rerun: Streamlit drops any element a rerun doesn't re-emit
+st.markdown(CHAT_CSS, unsafe_allow_html=True)
 
 st.title("💡 IdeaForge — Personal Idea Assistant")
 st.write("Get business & service ideas, naming, copy, and creative prompts quickly.")
@@ -80,53 +358,97 @@ st.write("Get business & service ideas, naming, copy, and creative prompts quick
 # ----------------- Session State -----------------
 if "history" not in st.session_state:
     st.session_state.history = []
+if "rendered" not in st.session_state:
+    st.session_state.rendered = []
+if "pending" not in st.session_state:
+    st.session_state.pending = []
+if "inflight" not in st.session_state:
+    st.session_state.inflight = None
 
 # ----------------- Sidebar -----------------
 with st.sidebar.expander("Settings", expanded=False):
     st.text_input("Gemini model", value=GEMINI_MODEL, key="_model_input")
+    st.slider("Context budget (tokens)", min_value=250, max_value=4000, value=CONTEXT_TOKEN_BUDGET, step=250, key="context_budget",
+              help="Approximate number of tokens of recent conversation sent with each request.")
+    st.checkbox("Queue requests", key="queue_mode", help="Collect several requests and send them to Gemini in one call.")
     st.caption("Set GEMINI_API_KEY in Streamlit Secrets or .env for deployment.")
+    if st.button("Clear cache"):
+        clear_reply_cache()
     st.markdown("**Usage tips:** Short instructions like 'List 5 product ideas for...' or '3 social post ideas for...'")
 
 # ----------------- Input Form -----------------
 with st.form(key="input_form", clear_on_submit=True):
     user_input = st.text_area("Ask for business ideas, services, names, slogans...", height=120)
     submitted = st.form_submit_button("Send")
-    if submitted and user_input.strip():
-        # Build conversation context
-        convo_text = "\n".join([f"User: {u}\nIdeaForge: {b}" for u, b in st.session_state.history[-6:]])
-        prompt = f"{convo_text}\nUser: {user_input}\nIdeaForge:"
-        
-        # Heuristic tweaks
-        if "service" in user_input.lower() and "business" not in user_input.lower():
-            prompt = f"{convo_text}\nUser: Give me creative service ideas only. {user_input}\nIdeaForge:"
-        elif "business" in user_input.lower() and "service" not in user_input.lower():
-            prompt = f"{convo_text}\nUser: Give me business ideas only — not personal services. {user_input}\nIdeaForge:"
-        
-        # Generate response
-        with st.spinner("Thinking... ✨"):
-            try:
-                reply = generate_with_gemini(prompt, max_output_tokens=768, temperature=0.7)
-                if not reply:
-                    reply = generate_with_gemini(prompt + "\nPlease try again concisely.", max_output_tokens=512, temperature=0.6)
-                if not reply:
-                    reply = "⚠️ I couldn't generate a response. Try simplifying the request."
-            except RuntimeError as e:
-                err = str(e)
-                if "429" in err:
-                    reply = "🚦 Gemini quota / rate limit reached. Try again later or use a different key."
-                else:
-                    reply = f"⚠️ Error calling Gemini: {err}"
-        
-        # Save to history
-        st.session_state.history.append((user_input.replace("\n","<br>"), reply.replace("\n","<br>")))
+
+if st.button("Clear chat"):
+    st.session_state.history = []
+    st.session_state.rendered = []
+    st.session_state.pending = []
+    # Stop any reply still decoding so it gives its worker and quota back
+    if st.session_state.inflight:
+        cancel_inflight(st.session_state.inflight)
+    st.session_state.inflight = None
+
+# ----------------- Handle Send -----------------
+if submitted and user_input.strip() and (st.session_state.queue_mode or st.session_state.inflight):
+    # Hold anything sent while a reply is still decoding instead of dropping it
+    st.session_state.pending.append(user_input)
+elif submitted and user_input.strip():
+    start_reply(user_input)
+
+# ----------------- Collect Finished Reply -----------------
+inflight = st.session_state.inflight
+replies = None
+if inflight and inflight["batch"]:
+    replies = poll_batch(inflight)
+elif inflight:
+    reply = poll_reply(inflight)
+    replies = [reply] if reply else None
+if replies:
+    st.session_state.inflight = None
+    # Whichever of primary/fallback lost is stopped so it stops using quota and a worker
+    cancel_inflight(inflight)
+    for user_text, reply in zip(inflight["user_texts"], replies):
+        add_turn(user_text, reply)
+
+# Outside queue mode, held sends go out one at a time as normal replies
+while st.session_state.pending and not st.session_state.inflight and not st.session_state.queue_mode:
+    start_reply(st.session_state.pending.pop(0))
+
+# ----------------- Queued Requests -----------------
+pending = st.session_state.pending
+if pending and st.session_state.queue_mode and not st.session_state.inflight and st.button(f"Send queued ({len(pending)})"):
+    # Longer queues go out BATCH_MAX_REQUESTS at a time; the rest stay queued
+    batch = pending[:BATCH_MAX_REQUESTS]
+    st.session_state.pending = pending[BATCH_MAX_REQUESTS:]
+    if len(batch) > 1:
+        start_batch(batch)
+    else:
+        start_reply(batch[0])
+elif pending:
+    st.caption(f"{len(pending)} request(s) queued.")
 
 # ----------------- Display Chat History -----------------
-for user_msg, bot_msg in st.session_state.history:
-    st.markdown(f"<div class='chat-row'><div class='user-bubble'><div class='meta'>You</div>{user_msg}</div></div>", unsafe_allow_html=True)
-    st.markdown(f"<div class='chat-row'><div class='bot-bubble'><div class='meta'>IdeaForge</div>{bot_msg}</div></div>", unsafe_allow_html=True)
+# One markdown element for the whole history instead of two per turn
+if st.session_state.rendered:
+    st.markdown("".join(st.session_state.rendered), unsafe_allow_html=True)
+
+# ----------------- Reply In Progress -----------------
+if st.session_state.inflight:
+    st.markdown(
+        "".join(bubble_html(user_text, role="user") for user_text in st.session_state.inflight["user_texts"])
+        + bubble_html(st.session_state.inflight["progress"]["text"] or "Thinking... ✨"),
+        unsafe_allow_html=True
+    )
 
 # ----------------- Footer -----------------
 st.markdown("---")
 st.markdown(
     "****"
 )
+
+# Keep polling the in-flight reply; each rerun redraws its partial text above
+if st.session_state.inflight:
+    time.sleep(0.1)
+    st.rerun()